@@ -3,14 +3,17 @@
 # Author: Jianyuan Guo (jyguo@pku.edu.cn)
 
 #change the conv in CMT block
+import os
 import math
 import logging
 from functools import partial
 from collections import OrderedDict
+from contextlib import nullcontext
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.helpers import load_pretrained
@@ -19,6 +22,14 @@ from timm.models.resnet import resnet26d, resnet50d
 from timm.models.registry import register_model
 from timm.models import load_checkpoint
 
+try:
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+    # flash for the mask-free CrossAttention, mem-efficient for Attention (flash does not take
+    # the relative_pos bias), math only as the last resort
+    _SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+except ImportError:
+    sdpa_kernel = None
+
 _logger = logging.getLogger(__name__)
 
 
@@ -32,6 +43,33 @@ def _cfg(url='', **kwargs):
         **kwargs
     }
 
+def _fuse_linear_state(state_dict, prefix, names, fused):
+    # checkpoints saved before the projections were fused keep one Linear per
+    # projection, concatenate them along the output dim into the fused Linear
+    for param in ('weight', 'bias'):
+        keys = [prefix + name + '.' + param for name in names]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + fused + '.' + param] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+# SDPA takes an explicit scale from torch 2.1 on
+_SDPA_HAS_SCALE = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1)
+
+def _attention(q, k, v, scale, dropout_p=0., bias=None):
+    # q, k, v [B, nhead, N, C//nhead], bias broadcastable to [B, nhead, Nq, Nk]
+    if bias is not None:
+        # an fp32 bias is cast to the (autocast) dtype of the scores
+        bias = bias.to(q.dtype)
+    if _SDPA_HAS_SCALE:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p, scale=scale)
+    # torch 2.0 always scales by 1/sqrt(head_dim), fold the remaining factor into q
+    return F.scaled_dot_product_attention(q * (scale * q.shape[-1] ** 0.5), k, v, attn_mask=bias, dropout_p=dropout_p)
+
+def _layer_norm(norm, x):
+    # call F.layer_norm on the module's parameters directly, skipping nn.Module.__call__
+    if type(norm) is nn.LayerNorm:
+        return F.layer_norm(x, norm.normalized_shape, norm.weight, norm.bias, norm.eps)
+    return norm(x)
+
 class CrossAttention(nn.Module):
     def __init__(self, dim1,dim2, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
         super().__init__()
@@ -40,17 +78,20 @@ class CrossAttention(nn.Module):
         self.dim = dim
         self.dim1 = dim1
         self.dim2 = dim2
-        self.scale = qk_scale or head_dim ** -0.5
+        self.scale = float(qk_scale or head_dim ** -0.5)
 
         self.q1 = nn.Linear(dim1, dim, bias=qkv_bias)
         self.proj = nn.Linear(dim, dim1)
 
-        self.k2 = nn.Linear(dim2, dim, bias=qkv_bias)
-        self.v2 = nn.Linear(dim2, dim, bias=qkv_bias)
+        self.kv2 = nn.Linear(dim2, dim * 2, bias=qkv_bias)
 
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj_drop = nn.Dropout(proj_drop)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _fuse_linear_state(state_dict, prefix, ('k2', 'v2'), 'kv2')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, fea, depth_fea):
         _, N1, _ = fea.shape
         B, N, _ = depth_fea.shape
@@ -59,14 +100,11 @@ class CrossAttention(nn.Module):
 
         # q [B, nhead, N, C//nhead]
 
-        k2 = self.k2(depth_fea).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
-        v2 = self.v2(depth_fea).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
-
-        attn = (q1 @ k2.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        kv2 = self.kv2(depth_fea).reshape(B, N, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        k2, v2 = kv2.unbind(0)
 
-        fea = (attn @ v2).transpose(1, 2).reshape(B, N1, C)
+        fea = _attention(q1, k2, v2, self.scale, dropout_p=self.attn_drop.p if self.training else 0.)
+        fea = fea.transpose(1, 2).reshape(B, N1, C)
         fea = self.proj(fea)
         fea = self.proj_drop(fea)
 
@@ -106,41 +144,57 @@ class Attention(nn.Module):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
-        self.scale = qk_scale or head_dim ** -0.5
+        self.scale = float(qk_scale or head_dim ** -0.5)
         self.qk_dim = dim // qk_ratio
 
-        self.q = nn.Linear(dim, self.qk_dim, bias=qkv_bias)
-        self.k = nn.Linear(dim, self.qk_dim, bias=qkv_bias)
-        self.v = nn.Linear(dim, dim, bias=qkv_bias)
+        self.sr_ratio = sr_ratio
+        # q, k and v read the same tokens unless k/v come from the reduced sequence
+        if self.sr_ratio > 1:
+            self.q = nn.Linear(dim, self.qk_dim, bias=qkv_bias)
+            self.kv = nn.Linear(dim, self.qk_dim + dim, bias=qkv_bias)
+        else:
+            self.qkv = nn.Linear(dim, self.qk_dim * 2 + dim, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         
-        self.sr_ratio = sr_ratio
         # Exactly same as PVTv1
         if self.sr_ratio > 1:
             self.sr = nn.Sequential(
                 nn.Conv2d(dim, dim, kernel_size=sr_ratio, stride=sr_ratio, groups=dim, bias=True),
                 nn.BatchNorm2d(dim, eps=1e-5),
-            )
+            ).to(memory_format=torch.channels_last)
+
+    def fuse(self):
+        # eval only: fold the sr BatchNorm into its conv
+        if self.sr_ratio > 1 and isinstance(self.sr, nn.Sequential):
+            self.sr = fuse_conv_bn_eval(self.sr[0], self.sr[1])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.sr_ratio > 1:
+            _fuse_linear_state(state_dict, prefix, ('k', 'v'), 'kv')
+        else:
+            _fuse_linear_state(state_dict, prefix, ('q', 'k', 'v'), 'qkv')
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x, H, W, relative_pos):
         B, N, C = x.shape
-        q = self.q(x).reshape(B, N, self.num_heads, self.qk_dim // self.num_heads).permute(0, 2, 1, 3)
         
         if self.sr_ratio > 1:
-            x_ = x.permute(0, 2, 1).reshape(B, C, H, W)
-            x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
-            k = self.k(x_).reshape(B, -1, self.num_heads, self.qk_dim // self.num_heads).permute(0, 2, 1, 3)
-            v = self.v(x_).reshape(B, -1, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+            q = self.q(x)
+            x_ = x.permute(0, 2, 1).reshape(B, C, H, W).to(memory_format=torch.channels_last)
+            # already contiguous while sr keeps the channels_last layout of x_, a no-op then;
+            # it only guards the kv Linear if sr ever returns NCHW
+            x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1).contiguous()
+            k, v = self.kv(x_).split([self.qk_dim, C], dim=-1)
         else:
-            k = self.k(x).reshape(B, N, self.num_heads, self.qk_dim // self.num_heads).permute(0, 2, 1, 3)
-            v = self.v(x).reshape(B, N, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
-        attn = (q @ k.transpose(-2, -1)) * self.scale 
-        attn = attn + relative_pos
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+            q, k, v = self.qkv(x).split([self.qk_dim, self.qk_dim, C], dim=-1)
+        q = q.reshape(B, N, self.num_heads, self.qk_dim // self.num_heads).permute(0, 2, 1, 3)
+        k = k.reshape(B, -1, self.num_heads, self.qk_dim // self.num_heads).permute(0, 2, 1, 3)
+        v = v.reshape(B, -1, self.num_heads, C // self.num_heads).permute(0, 2, 1, 3)
+        # relative_pos is an additive bias, broadcast over the batch
+        x = _attention(q, k, v, self.scale, dropout_p=self.attn_drop.p if self.training else 0., bias=relative_pos)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -159,13 +213,18 @@ class Block(nn.Module):
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         # self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
-        self.proj = nn.Conv2d(dim, dim, 3, 1, 1, groups=dim)
+        # cuDNN's depthwise kernels coalesce loads across channels in NHWC
+        self.proj = nn.Conv2d(dim, dim, 3, 1, 1, groups=dim).to(memory_format=torch.channels_last)
         
     def forward(self, x, H, W, relative_pos):
         B, N, C = x.shape
-        x = x + self.drop_path(self.attn(self.norm1(x), H, W, relative_pos))
+        attn = self.attn(_layer_norm(self.norm1, x), H, W, relative_pos)
+        # DropPath is the identity at eval, skip the module call
+        x = x + (self.drop_path(attn) if self.training else attn)
         # x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
-        cnn_feat = x.permute(0, 2, 1).reshape(B, C, H, W)
+        # [B, N, C] tokens viewed as [B, C, H, W] are channels_last, and so is the conv output,
+        # so both layout changes here are views
+        cnn_feat = x.reshape(B, H, W, C).permute(0, 3, 1, 2).to(memory_format=torch.channels_last)
         x = self.proj(cnn_feat) + cnn_feat
         x = x.flatten(2).permute(0, 2, 1)
         return x
@@ -186,8 +245,19 @@ class PatchEmbed(nn.Module):
         self.patch_size = patch_size
         self.num_patches = num_patches
 
-        self.project = nn.Linear(in_chans, in_chans * kernel_size * kernel_size)
-        self.upsample = nn.Fold(output_size=(ms*stride, ms*stride) , kernel_size=(kernel_size, kernel_size), stride=(stride, stride), padding=(padding, padding))
+        # per-pixel Linear to k*k patches + Fold is a transposed conv, output_padding restores
+        # the ms*stride output size that Fold was given
+        output_padding = ms * stride - ((ms - 1) * stride - 2 * padding + kernel_size)
+        self.upconv = nn.ConvTranspose2d(in_chans, in_chans, kernel_size, stride=stride, padding=padding,
+                                         output_padding=output_padding, bias=False)
+        # keep the Linear(in_chans, ...) init: ConvTranspose2d's default takes fan_in as in_chans*k*k,
+        # which would shrink the fresh weights by k
+        bound = 1 / math.sqrt(in_chans)
+        nn.init.uniform_(self.upconv.weight, -bound, bound)
+        # the Linear bias is per patch position, so overlapping patches sum to a spatially varying bias
+        self.upconv_bias = nn.Parameter(torch.empty(1, in_chans, kernel_size, kernel_size).uniform_(-bound, bound))
+        # expanded [1, C, H*s, W*s] bias, only cached in eval where upconv_bias is constant
+        self._upconv_bias_map = None
         self.norm = nn.LayerNorm(in_chans)
         self.norm2 = nn.LayerNorm(embed_dim)
         self.norm3 = nn.LayerNorm(embed_dim)
@@ -207,34 +277,80 @@ class PatchEmbed(nn.Module):
                 nn.GELU(),
                 nn.Linear(in_chans, embed_dim),
             )
-            
+
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the transposed conv store the project Linear
+        if prefix + 'project.weight' in state_dict:
+            k = self.upconv.kernel_size[0]
+            weight = state_dict.pop(prefix + 'project.weight')
+            c_out, c_in = weight.shape[0] // (k * k), weight.shape[1]
+            state_dict[prefix + 'upconv.weight'] = weight.reshape(c_out, k, k, c_in).permute(3, 0, 1, 2).contiguous()
+            state_dict[prefix + 'upconv_bias'] = state_dict.pop(prefix + 'project.bias').reshape(1, c_out, k, k)
+        self._upconv_bias_map = None
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def train(self, mode=True):
+        self._upconv_bias_map = None
+        return super().train(mode)
+
+    def _upconv_bias(self, H, W, out):
+        # bias map for an H x W input, matching the device / dtype of the upconv output
+        bias = self._upconv_bias_map
+        if self.training or bias is None or bias.device != out.device or bias.dtype != out.dtype:
+            # upconv_bias is trained, so it has to be re-expanded on every training step
+            bias = F.conv_transpose2d(out.new_ones(1, 1, H, W), self.upconv_bias.to(out.dtype),
+                                      stride=self.upconv.stride, padding=self.upconv.padding,
+                                      output_padding=self.upconv.output_padding)
+            if not self.training:
+                self._upconv_bias_map = bias.detach()
+        return bias
+
     def forward(self, x, enc_fea):
         B, C, H, W = x.shape
         # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
-        x = self.project(x.flatten(2).transpose(1, 2))
-        x = self.upsample(x.transpose(1,2))
+        torch._assert(H == self.img_size[0] and W == self.img_size[1],
+            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]}).")
+        x = self.upconv(x)
+        x = x + self._upconv_bias(H, W, x)
         x = self.lpu(x) + x
         x = x.flatten(2).transpose(1, 2)
-        x = self.norm(x)
-        x0 = x.clone()
+        x = _layer_norm(self.norm, x)
+        # x is rebound below, never written in place, so no copy is needed
+        x0 = x
         H, W = H * self.patch_size[0], W * self.patch_size[1]
         # print(enc_fea.shape, x.shape)
         if self.fuse:
-            x = self.norm2(self.concatFuse(torch.cat([x, enc_fea], dim=2)))
+            x = _layer_norm(self.norm2, self.concatFuse(torch.cat([x, enc_fea], dim=2)))
             x = x + self.interact(x, x0)
-            x = self.norm3(x)
+            x = _layer_norm(self.norm3, x)
         else:
-            x = self.norm2(self.concatFuse(x))
+            x = _layer_norm(self.norm2, self.concatFuse(x))
         return x, (H, W)
     
+class _PatchEmbedTokens(nn.Module):
+    # export wrapper: only the tokens are traced, the (H, W) output is a constant of img_size
+    def __init__(self, patch_embed, amp_dtype):
+        super().__init__()
+        self.patch_embed = patch_embed
+        self.amp_dtype = amp_dtype
+
+    def forward(self, x, enc_fea):
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None and x.is_cuda):
+            return self.patch_embed(x, enc_fea)[0]
+
 class DecoderC(nn.Module):
     def __init__(self, img_size=224, in_chans=3, num_classes=1000, embed_dims=[384,128,64,16,4], stem_channel=16, fc_dim=1280,
                  num_heads=[1,2,4,8], mlp_ratios=[3.6,3.6,3.6,3.6], qkv_bias=True, qk_scale=None, representation_size=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None,
-                 depths=[2,3,6,3], qk_ratio=1, sr_ratios=[8,4,2,1], dp=0.1):
+                 depths=[2,3,6,3], qk_ratio=1, sr_ratios=[8,4,2,1], dp=0.1, compile_mode=None,
+                 amp_dtype=torch.bfloat16, rel_pos_rank=None):
         super().__init__()
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        self.amp_dtype = amp_dtype
+        # set by aot_compile_patch_embeds, the artifacts hold a frozen copy of the PatchEmbed weights
+        self.patch_embeds_aot = False
         self.norm = nn.LayerNorm(embed_dims[0])
         self.mlp = nn.Sequential(
                     nn.Linear(embed_dims[0], embed_dims[0]),
@@ -254,22 +370,30 @@ class DecoderC(nn.Module):
         #     num_heads[0], self.patch_embed_a.num_patches, self.patch_embed_a.num_patches//sr_ratios[0]//sr_ratios[0]))
         # self.relative_pos_b = nn.Parameter(torch.randn(
         #     num_heads[1], self.patch_embed_b.num_patches, self.patch_embed_b.num_patches//sr_ratios[1]//sr_ratios[1]))
-        self.relative_pos_c = nn.Parameter(torch.randn(
-            num_heads[2], self.patch_embed_c.num_patches, self.patch_embed_c.num_patches//sr_ratios[2]//sr_ratios[2]))
-        self.relative_pos_d = nn.Parameter(torch.randn(
-            num_heads[3], self.patch_embed_d.num_patches, self.patch_embed_d.num_patches//sr_ratios[3]//sr_ratios[3]))
+        # with rel_pos_rank the [heads, N, N/sr^2] biases are learned as U @ V^T factors,
+        # U and V entries scaled so the product keeps the unit variance of the full randn init
+        self.rel_pos_rank = rel_pos_rank
+        for name, heads, patch_embed, sr in (('relative_pos_c', num_heads[2], self.patch_embed_c, sr_ratios[2]),
+                                             ('relative_pos_d', num_heads[3], self.patch_embed_d, sr_ratios[3])):
+            N = patch_embed.num_patches
+            if rel_pos_rank:
+                setattr(self, name + '_u', nn.Parameter(torch.randn(heads, N, rel_pos_rank) * rel_pos_rank ** -0.25))
+                setattr(self, name + '_v', nn.Parameter(torch.randn(heads, N//sr//sr, rel_pos_rank) * rel_pos_rank ** -0.25))
+            else:
+                setattr(self, name, nn.Parameter(torch.randn(heads, N, N//sr//sr)))
         
-        self.pre_1_16 = nn.Linear(embed_dims[1], 1)
-        self.pre_1_8 = nn.Linear(embed_dims[1], 1)
-        self.pre_1_4 = nn.Linear(embed_dims[2], 1)
-        self.pre_1_1 = nn.Linear(embed_dims[3], 1)
+        # per-token prediction heads as 1x1 convs, so they write [B, 1, h, w] masks directly
+        self.pre_1_16 = nn.Conv2d(embed_dims[1], 1, 1)
+        self.pre_1_8 = nn.Conv2d(embed_dims[1], 1, 1)
+        self.pre_1_4 = nn.Conv2d(embed_dims[2], 1, 1)
+        self.pre_1_1 = nn.Conv2d(embed_dims[3], 1, 1)
 
         self.s1 = nn.Sigmoid()
         self.s2 = nn.Sigmoid()
         self.s3 = nn.Sigmoid()
         self.s4 = nn.Sigmoid()
         
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]  # stochastic depth decay rule
+        dpr = torch.linspace(0, drop_path_rate, sum(depths)).tolist()  # stochastic depth decay rule
         cur = 0
         # self.blocks_a = nn.ModuleList([
         #     Block(
@@ -311,6 +435,11 @@ class DecoderC(nn.Module):
 
         # Classifier head
 
+        # all shapes are fixed by img_size, so compile once without dynamic shapes to let
+        # inductor fuse the pointwise / norm chains and capture the block loops in CUDA graphs
+        if compile_mode is not None:
+            self.forward_features = torch.compile(self.forward_features, mode=compile_mode, fullgraph=False, dynamic=False)
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -327,6 +456,54 @@ class DecoderC(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
             
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.patch_embeds_aot:
+            raise RuntimeError('PatchEmbed weights are baked into the AOT artifacts, load weights before aot_compile_patch_embeds')
+        # checkpoints from before the heads were convs store [1, C] Linear weights
+        for name in ('pre_1_16', 'pre_1_8', 'pre_1_4', 'pre_1_1'):
+            key = prefix + name + '.weight'
+            if key in state_dict and state_dict[key].dim() == 2:
+                state_dict[key] = state_dict[key][:, :, None, None]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def fuse(self):
+        # call after loading weights and net.eval(), the fused state dict no longer matches checkpoints
+        if self.patch_embeds_aot:
+            raise RuntimeError('fuse() must be called before aot_compile_patch_embeds')
+        for m in self.modules():
+            if isinstance(m, Attention):
+                m.fuse()
+
+    @torch.no_grad()
+    def aot_compile_patch_embeds(self, x, x_1_8, x_1_4, package_dir='./'):
+        # inference only: every PatchEmbed runs on static shapes fixed by img_size, export each one
+        # with the inputs of a dummy forward and swap its forward for the AOT Inductor artifact.
+        # The artifacts bake in the current weights, so this must be the last step after
+        # load_state_dict / fuse(); both refuse to run afterwards.
+        assert not self.training, 'AOT compiled PatchEmbed has no backward, call eval() first'
+        assert not self.patch_embeds_aot, 'PatchEmbeds are already AOT compiled'
+        # the artifacts are called eagerly, and the dummy forward only has to record shapes,
+        # so drop the torch.compile wrapper around forward_features first
+        self.__dict__.pop('forward_features', None)
+        names = ('patch_embed_b', 'patch_embed_c', 'patch_embed_d')
+        example_args = {}
+        hooks = [getattr(self, name).register_forward_pre_hook(
+                     lambda m, args, name=name: example_args.__setitem__(name, args)) for name in names]
+        self(x, x_1_8, x_1_4)
+        for hook in hooks:
+            hook.remove()
+
+        for name in names:
+            patch_embed = getattr(self, name)
+            exported = torch.export.export(_PatchEmbedTokens(patch_embed, self.amp_dtype), example_args[name])
+            package_path = torch._inductor.aoti_compile_and_package(
+                exported, package_path=os.path.join(package_dir, name + '.pt2'),
+                inductor_configs={'max_autotune': True, 'coordinate_descent_tuning': True})
+            compiled = torch._inductor.aoti_load_package(package_path)
+            HW = (patch_embed.img_size[0] * patch_embed.patch_size[0], patch_embed.img_size[1] * patch_embed.patch_size[1])
+            patch_embed.forward = lambda x, enc_fea, compiled=compiled, HW=HW: (compiled(x, enc_fea), HW)
+        self.patch_embeds_aot = True
+
     def update_temperature(self):
         for m in self.modules():
             if isinstance(m, Attention):
@@ -337,45 +514,62 @@ class DecoderC(nn.Module):
         return {'pos_embed', 'cls_token'}
 
 
+    def _relative_pos(self, name, dtype=None):
+        if self.rel_pos_rank:
+            relative_pos = getattr(self, name + '_u') @ getattr(self, name + '_v').transpose(1, 2)
+        else:
+            relative_pos = getattr(self, name)
+        # cast once per forward instead of in every block's attention call
+        return relative_pos if dtype is None else relative_pos.to(dtype)
+
+    def _predict(self, head, x):
+        # mask logits feed the BCE / IoU losses, compute them in fp32
+        with torch.autocast('cuda', enabled=False):
+            return head(x.float())
+
     def forward_features(self, x, x_1_8, x_1_4):
         B, N, C = x.shape
+        # bf16 halves the bandwidth of the memory-bound attention and projection GEMMs,
+        # the mask heads are kept in fp32 (see _predict)
+        use_amp = self.amp_dtype is not None and x.is_cuda
+        with torch.autocast('cuda', dtype=self.amp_dtype, enabled=use_amp):
+            relative_pos_c = self._relative_pos('relative_pos_c', self.amp_dtype if use_amp else None)
+            relative_pos_d = self._relative_pos('relative_pos_d', self.amp_dtype if use_amp else None)
         
-        saliency_fea_1_16 = self.mlp(self.norm(x))
-        mask_1_16 = self.pre_1_16(saliency_fea_1_16)
-        mask_1_16 = mask_1_16.transpose(1, 2).reshape(B, 1, self.img_size // 16, self.img_size // 16)
+            saliency_fea_1_16 = self.mlp(_layer_norm(self.norm, x))
+            saliency_fea_1_16 = saliency_fea_1_16.reshape(B, self.img_size // 16, self.img_size // 16, -1).permute(0, 3, 1, 2)
+            mask_1_16 = self._predict(self.pre_1_16, saliency_fea_1_16)
         
-        x = x.transpose(1,2).reshape(B, C, 14, 14)
-        x, (H, W) = self.patch_embed_d(x, x_1_8)
-        for i, blk in enumerate(self.blocks_d):
-            x = blk(x, H, W, self.relative_pos_d)
+            x = x.transpose(1,2).reshape(B, C, 14, 14)
+            x, (H, W) = self.patch_embed_d(x, x_1_8)
+            for i, blk in enumerate(self.blocks_d):
+                x = blk(x, H, W, relative_pos_d)
         
- #       x_1_8
-        mask_1_8 = self.pre_1_8(x)
-        mask_1_8 = mask_1_8.transpose(1, 2).reshape(B, 1, self.img_size // 8, self.img_size // 8)
-
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
-        x, (H, W) = self.patch_embed_c(x, x_1_4)
-        for i, blk in enumerate(self.blocks_c):
-            x = blk(x, H, W, self.relative_pos_c)
+     #       x_1_8
+            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2)
+            mask_1_8 = self._predict(self.pre_1_8, x)
+
+            x, (H, W) = self.patch_embed_c(x, x_1_4)
+            for i, blk in enumerate(self.blocks_c):
+                x = blk(x, H, W, relative_pos_c)
             
-        mask_1_4 = self.pre_1_4(x)
-        mask_1_4 = mask_1_4.transpose(1, 2).reshape(B, 1, self.img_size // 4, self.img_size // 4)
-        # x_1_16      
-        x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
-        x, (H, W) = self.patch_embed_b(x, None)
-        # for i, blk in enumerate(self.blocks_b):
-        #     x = blk(x, H, W, self.relative_pos_b)
+            x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2)
+            mask_1_4 = self._predict(self.pre_1_4, x)
+            # x_1_16      
+            x, (H, W) = self.patch_embed_b(x, None)
+            # for i, blk in enumerate(self.blocks_b):
+            #     x = blk(x, H, W, self.relative_pos_b)
             
-        mask_1_1 = self.pre_1_1(x)
-        mask_1_1 = mask_1_1.transpose(1, 2).reshape(B, 1, self.img_size // 1, self.img_size // 1)
-        # x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
-        # x, (H, W) = self.patch_embed_d(x)
-        # for i, blk in enumerate(self.blocks_d):
-        #     x = blk(x, H, W, self.relative_pos_d)
-        return [mask_1_16, mask_1_8, mask_1_4, mask_1_1]
+            mask_1_1 = self._predict(self.pre_1_1, x.reshape(B, H, W, -1).permute(0, 3, 1, 2))
+            # x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
+            # x, (H, W) = self.patch_embed_d(x)
+            # for i, blk in enumerate(self.blocks_d):
+            #     x = blk(x, H, W, self.relative_pos_d)
+            return [mask_1_16, mask_1_8, mask_1_4, mask_1_1]
 
     def forward(self, x, x_1_8, x_1_4):
-        [mask_1_16, mask_1_8, mask_1_4, mask_1_1] = self.forward_features(x, x_1_8, x_1_4)
+        with sdpa_kernel(_SDPA_BACKENDS) if sdpa_kernel is not None else nullcontext():
+            [mask_1_16, mask_1_8, mask_1_4, mask_1_1] = self.forward_features(x, x_1_8, x_1_4)
 
         m_1 = self.s1(mask_1_1)
         m_4 = self.s2(mask_1_4)
@@ -10,12 +10,16 @@ from cmt import cmt_s
 import transforms 
 from pvtv2 import pvt_v2_b2
 from torch import Tensor
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 # from C_Resnet_model import CPD_ResNet
 
+class _StopForward(Exception):
+    pass
+
 class ImageDepthNet7(nn.Module):
     
 
-    def __init__(self, args):
+    def __init__(self, args, compile_mode=None):
         super(ImageDepthNet7, self).__init__()
 
 
@@ -35,7 +39,7 @@ class ImageDepthNet7(nn.Module):
 
         # MFF-Net Decoder
         self.token_trans = token_Transformer(embed_dim=384, depth=4, num_heads=6, mlp_ratio=3.)
-        self.decoder = DecoderC()
+        self.decoder = DecoderC(compile_mode=compile_mode)
         self.concatFuse = nn.Sequential(
                 nn.Linear(320+256, 384),
                 nn.GELU(),
@@ -88,6 +92,31 @@ class ImageDepthNet7(nn.Module):
 
         return masks
 
+    @torch.no_grad()
+    def aot_compile_patch_embeds(self, image_Input, package_dir):
+        # record the decoder inputs for one image, stopping before the decoder itself runs
+        decoder_args = []
+
+        def capture(module, args):
+            decoder_args.extend(args)
+            raise _StopForward
+
+        hook = self.decoder.register_forward_pre_hook(capture)
+        try:
+            self(image_Input)
+        except _StopForward:
+            pass
+        finally:
+            hook.remove()
+        self.decoder.aot_compile_patch_embeds(*decoder_args, package_dir=package_dir)
+
+    def fuse(self):
+        # inference only: fold Conv-BN pairs, call after load_state_dict and eval()
+        for m in self.modules():
+            if isinstance(m, BasicConv2d):
+                m.fuse()
+        self.decoder.fuse()
+
 class SpatialAttention(nn.Module):
     def __init__(self, kernel_size=7):
         super(SpatialAttention, self).__init__()
@@ -196,6 +225,12 @@ class BasicConv2d(nn.Module):
         self.bn = nn.BatchNorm2d(out_planes)
         self.relu = nn.ReLU(inplace=True)
 
+    def fuse(self):
+        # eval only: fold bn's affine into conv's weight/bias
+        if isinstance(self.bn, nn.BatchNorm2d):
+            self.conv = fuse_conv_bn_eval(self.conv, self.bn)
+            self.bn = nn.Identity()
+
     def forward(self, x):
         x = self.conv(x)
         x = self.bn(x)
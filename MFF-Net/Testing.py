@@ -21,7 +21,12 @@ def test_net(args, path):
 
     cudnn.benchmark = True
 
-    net = ImageDepthNet7(args)
+    # the AOT artifacts are called eagerly, aot_compile_patch_embeds removes the torch.compile wrapper
+    if args.aot_patch_embed and args.test_compile_mode is not None:
+        raise ValueError('--aot_patch_embed and --test_compile_mode cannot be combined')
+
+    # test_net builds a fresh model on every call from the training loop, so it has its own flag
+    net = ImageDepthNet7(args, compile_mode=args.test_compile_mode)
     # net = nn.DataParallel(net)
     # net = ImageDepthNet3(args)
     net.cuda()
@@ -42,6 +47,7 @@ def test_net(args, path):
     # load params
     net.load_state_dict(new_state_dict)
     print('Model loaded from {}'.format(model_path))
+    net.fuse()
 
     # load model
     # net.load_state_dict(torch.load(model_path))
@@ -51,15 +57,17 @@ def test_net(args, path):
     test_paths = args.test_paths
     test_dir_img = test_paths
 
-    test_dataset = get_loader(test_dir_img, args.data_root, args.img_size, mode='test')
-
-    test_loader = data.DataLoader(dataset=test_dataset, batch_size=1, shuffle=False, num_workers=1)
+    test_loader = get_loader(test_dir_img, args.data_root, args.img_size, mode='test', batch_size=1, num_workers=1)
     print('''
                 Starting testing:
                     dataset: {}
                     Testing size: {}
                 '''.format(test_dir_img.split('/')[0], len(test_loader.dataset)))
 
+    if args.aot_patch_embed:
+        # bakes the loaded, fused weights into the artifacts, so it has to come last
+        net.aot_compile_patch_embeds(next(iter(test_loader))[0].cuda(), args.save_model_dir)
+
     time_list = []
     for i, data_batch in enumerate(test_loader):
         images, image_w, image_h, image_path = data_batch
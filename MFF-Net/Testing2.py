@@ -52,9 +52,7 @@ def test_net(args):
         test_paths = args.test_paths
         test_dir_img = test_paths
 
-        test_dataset = get_loader(test_dir_img, args.data_root, args.img_size, mode='test')
-
-        test_loader = data.DataLoader(dataset=test_dataset, batch_size=1, shuffle=False, num_workers=1)
+        test_loader = get_loader(test_dir_img, args.data_root, args.img_size, mode='test', batch_size=1, num_workers=1)
         print('''
                     Starting testing:
                         dataset: {}
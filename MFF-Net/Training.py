@@ -6,7 +6,7 @@ from torch.autograd import Variable
 import torch.multiprocessing as mp
 import torch.distributed as dist
 
-from dataset import get_loader
+from dataset import get_loader, label_pyramid
 import math
 from ImageDepthNet7 import ImageDepthNet7
 import os
@@ -50,7 +50,7 @@ def train_net(num_gpus, args):
 
 def main(local_rank, num_gpus, args):
 
-    net = ImageDepthNet7(args)
+    net = ImageDepthNet7(args, compile_mode=args.compile_mode)
 
     net.cuda()
 
@@ -63,14 +63,8 @@ def main(local_rank, num_gpus, args):
     optimizer = optim.Adam([{'params': base_params, 'lr': args.lr * 0.1},
                             {'params': other_params, 'lr': args.lr}])
 
-    train_dataset = get_loader(args.trainset, args.data_root, args.img_size, mode='train')
-
-    
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, num_workers=1,
-                                               # pin_memory=True,
-                                               # sampler=sampler,
-                                               drop_last=True,
-                                               )
+    train_loader = get_loader(args.trainset, args.data_root, args.img_size, mode='train', cache_path=args.cache_path,
+                              batch_size=args.batch_size)
 
     print('''
         Starting training:
@@ -102,13 +96,12 @@ def main(local_rank, num_gpus, args):
         for i, data_batch in enumerate(train_loader):
             if (i + 1) > iter_num: break
 
-            images, label_224, label_14, label_28, label_56, label_112 = data_batch
+            images, label_224 = data_batch
 
             images, label_224 = Variable(images.cuda(non_blocking=True)), \
                                         Variable(label_224.cuda(non_blocking=True))
 
-            label_14, label_28, label_56, label_112 = Variable(label_14.cuda()), Variable(label_28.cuda()),\
-                                                      Variable(label_56.cuda()), Variable(label_112.cuda())
+            label_14, label_28, label_56, label_112 = label_pyramid(label_224, args.img_size)
 
             outputs_saliency = net(images)
 
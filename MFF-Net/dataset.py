@@ -1,91 +1,45 @@
-from PIL import Image
+import numpy as np
+import torch
+import torch.nn.functional as F
 from torch.utils import data
-import transforms as trans
-from torchvision import transforms
-import random
+from torchvision import tv_tensors
+from torchvision.io import read_image, ImageReadMode
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import v2
 import os
 
 
-def load_list(dataset_name, data_root):
-
-    images = []
-    labels = []
-    
-
-    img_root = data_root + 'ISTD_SP' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.png')
-
-    img_root = data_root + 'ISTD_DSC' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.png')
-    
-    img_root = data_root + 'ISTD_DC' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.png')
-    
-    img_root = data_root + 'ISTD_BM' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
 
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.png')
-    
-    img_root = data_root + 'ISTD_TG' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
 
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.png')
+# (subdir, image ext, label ext) of every training split under data_root
+TRAIN_SETS = [
+    ('ISTD_SP', 'png', 'png'),
+    ('ISTD_DSC', 'png', 'png'),
+    ('ISTD_DC', 'png', 'png'),
+    ('ISTD_BM', 'png', 'png'),
+    ('ISTD_TG', 'png', 'png'),
+    ('SRD_BM', 'jpg', 'jpg'),
+    ('SRD_DC', 'png', 'jpg'),
+    ('SRD_DSC', 'jpg', 'jpg'),
+    ('SRD_TG', 'jpg', 'jpg'),
+]
 
-    img_root = data_root + 'SRD_BM' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
 
-        images.append(img_root + img[:-4]+'.jpg')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.jpg')
-    
-    img_root = data_root + 'SRD_DC' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.png')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.jpg')
-    
-    img_root = data_root + 'SRD_DSC' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.jpg')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.jpg')
-    
-    img_root = data_root + 'SRD_TG' + '/train_A/'
-    img_files = os.listdir(img_root)
-
-    for img in img_files:
-
-        images.append(img_root + img[:-4]+'.jpg')
-        labels.append(img_root.replace('/train_A/', '/train_B/') + img[:-4]+'.jpg')
-    
+def load_list(dataset_name, data_root):
 
+    images = []
+    labels = []
 
+    for name, img_ext, label_ext in TRAIN_SETS:
+        img_root = data_root + name + '/train_A/'
+        label_root = data_root + name + '/train_B/'
+        with os.scandir(img_root) as entries:
+            for entry in entries:
+                stem = entry.name.rsplit('.', 1)[0]
+                images.append(img_root + stem + '.' + img_ext)
+                labels.append(label_root + stem + '.' + label_ext)
 
     # img_root = data_root + 'ISTD2/ISTD2' + '/train_A/'
     # img_files = os.listdir(img_root)
@@ -132,7 +86,7 @@ def load_test_list(test_path, data_root):
 
 
 class ImageData(data.Dataset):
-    def __init__(self, dataset_list, data_root, transform, mode, img_size=None, scale_size=None, t_transform=None, label_14_transform=None, label_28_transform=None, label_56_transform=None, label_112_transform=None):
+    def __init__(self, dataset_list, data_root, transform, mode, img_size=None, scale_size=None, t_transform=None, cache_path=None):
 
         if mode == 'train':
             self.image_path, self.label_path = load_list(dataset_list, data_root)
@@ -141,54 +95,88 @@ class ImageData(data.Dataset):
 
         self.transform = transform
         self.t_transform = t_transform
-        self.label_14_transform = label_14_transform
-        self.label_28_transform = label_28_transform
-        self.label_56_transform = label_56_transform
-        self.label_112_transform = label_112_transform
         self.mode = mode
         self.img_size = img_size
         self.scale_size = scale_size
 
+        if mode == 'train':
+            # Image/Mask pairs share the sampled crop and flip, see load_pair for the resize
+            self.resize = v2.Resize((scale_size, scale_size), antialias=True)
+            self.augment = v2.Compose([
+                v2.RandomCrop(img_size),
+                v2.RandomHorizontalFlip(),
+            ])
+
+        # training images resized to scale_size, kept as uint8 .npy files and memory-mapped
+        self.cache_path = cache_path
+        self.img_mmap = None
+        self.label_mmap = None
+        if mode == 'train' and cache_path is not None:
+            if not self.cache_is_valid():
+                self.precompute_cache()
+            self.img_mmap = np.load(cache_path + '_img.npy', mmap_mode='r')
+            self.label_mmap = np.load(cache_path + '_label.npy', mmap_mode='r')
+
+    def cache_is_valid(self):
+        # a cache built from another file list or scale_size would pair the wrong images and labels
+        files = [self.cache_path + suffix for suffix in ('_img.npy', '_label.npy', '_paths.txt')]
+        if not all(os.path.exists(f) for f in files):
+            return False
+        size = self.scale_size
+        if np.load(files[0], mmap_mode='r').shape != (len(self.image_path), 3, size, size):
+            return False
+        if np.load(files[1], mmap_mode='r').shape != (len(self.label_path), 1, size, size):
+            return False
+        with open(files[2]) as f:
+            return f.read().splitlines() == self.image_path
+
+    def load_pair(self, item):
+        image = self.resize(tv_tensors.Image(read_image(self.image_path[item], ImageReadMode.RGB)))
+        # v2 resizes a Mask with NEAREST, which is offset from PIL's NEAREST; NEAREST_EXACT
+        # samples the same pixels and keeps the label aligned with the bilinear image
+        label = v2.functional.resize(read_image(self.label_path[item], ImageReadMode.GRAY),
+                                     [self.scale_size, self.scale_size], interpolation=InterpolationMode.NEAREST_EXACT)
+        return image, tv_tensors.Mask(label)
+
+    def precompute_cache(self):
+        size = self.scale_size
+        img_cache = np.lib.format.open_memmap(self.cache_path + '_img.npy', mode='w+', dtype=np.uint8,
+                                              shape=(len(self.image_path), 3, size, size))
+        label_cache = np.lib.format.open_memmap(self.cache_path + '_label.npy', mode='w+', dtype=np.uint8,
+                                                shape=(len(self.label_path), 1, size, size))
+        for i in range(len(self.image_path)):
+            image, label = self.load_pair(i)
+            img_cache[i] = image.numpy()
+            label_cache[i] = label.numpy()
+        img_cache.flush()
+        label_cache.flush()
+        del img_cache, label_cache
+        with open(self.cache_path + '_paths.txt', 'w') as f:
+            f.write('\n'.join(self.image_path) + '\n')
+
     def __getitem__(self, item):
-        fn = self.image_path[item].split('/')
 
-        filename = fn[-1]
+        if self.mode == 'train':
+            if self.img_mmap is not None:
+                image = tv_tensors.Image(torch.from_numpy(np.array(self.img_mmap[item])))
+                label = tv_tensors.Mask(torch.from_numpy(np.array(self.label_mmap[item])))
+            else:
+                image, label = self.load_pair(item)
 
-        image = Image.open(self.image_path[item]).convert('RGB')
-        image_w, image_h = int(image.size[0]), int(image.size[1])
+            # random crop, random flip
+            new_img, new_label = self.augment(image, label)
 
-        if self.mode == 'train':
+            new_img = self.transform(new_img.as_subclass(torch.Tensor))
 
-            label = Image.open(self.label_path[item]).convert('L')
-            random_size = self.scale_size
-
-            new_img = trans.Scale((random_size, random_size))(image)
-            new_label = trans.Scale((random_size, random_size), interpolation=Image.NEAREST)(label)
-            # random crop
-            w, h = new_img.size
-            if w != self.img_size and h != self.img_size:
-                x1 = random.randint(0, w - self.img_size)
-                y1 = random.randint(0, h - self.img_size)
-                new_img = new_img.crop((x1, y1, x1 + self.img_size, y1 + self.img_size))
-                new_label = new_label.crop((x1, y1, x1 + self.img_size, y1 + self.img_size))
-
-            # random flip
-            if random.random() < 0.5:
-                new_img = new_img.transpose(Image.FLIP_LEFT_RIGHT)
-                new_label = new_label.transpose(Image.FLIP_LEFT_RIGHT)
-
-            new_img = self.transform(new_img)
-
-            label_14 = self.label_14_transform(new_label)
-            label_28 = self.label_28_transform(new_label)
-            label_56 = self.label_56_transform(new_label)
-            label_112 = self.label_112_transform(new_label)
-            label_224 = self.t_transform(new_label)
-
-        # return label_224, self.image_path[item]
-            return new_img, label_224, label_14, label_28, label_56, label_112
+            label_224 = self.t_transform(new_label.as_subclass(torch.Tensor))
+
+            # the downsampled labels are built per batch on the GPU, see label_pyramid
+            return new_img, label_224
         else:
 
+            image = read_image(self.image_path[item], ImageReadMode.RGB)
+            image_h, image_w = int(image.shape[1]), int(image.shape[2])
+
             image = self.transform(image)
 
             return image, image_w, image_h, self.image_path[item]
@@ -197,46 +185,39 @@ class ImageData(data.Dataset):
         return len(self.image_path)
 
 
-def get_loader(dataset_list, data_root, img_size, mode='train'):
+def label_pyramid(label_224, img_size):
+    # one nearest-exact interpolate per scale on the whole batch, nearest-exact samples
+    # the same pixels as PIL's NEAREST resize
+    return [F.interpolate(label_224, size=(img_size // s, img_size // s), mode='nearest-exact')
+            for s in (16, 8, 4, 2)]
+
+
+def get_loader(dataset_list, data_root, img_size, mode='train', cache_path=None, batch_size=1, num_workers=8):
 
     if mode == 'train':
 
-        transform = trans.Compose([
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+        transform = v2.Compose([
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(MEAN, STD),
         ])
 
-        t_transform = trans.Compose([
-            transforms.ToTensor(),
-        ])
-        label_14_transform = trans.Compose([
-            trans.Scale((img_size // 16, img_size // 16), interpolation=Image.NEAREST),
-            transforms.ToTensor(),
-        ])
-        label_28_transform = trans.Compose([
-            trans.Scale((img_size//8, img_size//8), interpolation=Image.NEAREST),
-            transforms.ToTensor(),
-        ])
-        label_56_transform = trans.Compose([
-            trans.Scale((img_size//4, img_size//4), interpolation=Image.NEAREST),
-            transforms.ToTensor(),
-        ])
-        label_112_transform = trans.Compose([
-            trans.Scale((img_size//2, img_size//2), interpolation=Image.NEAREST),
-            transforms.ToTensor(),
-        ])
+        t_transform = v2.ToDtype(torch.float32, scale=True)
         scale_size = 256
     else:
-        transform = trans.Compose([
-            trans.Scale((img_size, img_size)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),  # 处理的是Tensor
+        transform = v2.Compose([
+            v2.Resize((img_size, img_size), antialias=True),
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Normalize(MEAN, STD),  # 处理的是Tensor
         ])
 
     if mode == 'train':
-        dataset = ImageData(dataset_list, data_root, transform, mode, img_size, scale_size, t_transform, label_14_transform, label_28_transform, label_56_transform, label_112_transform)
+        dataset = ImageData(dataset_list, data_root, transform, mode, img_size, scale_size, t_transform, cache_path)
     else:
         dataset = ImageData(dataset_list, data_root, transform, mode)
 
-    # data_loader = data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_thread)
-    return dataset
\ No newline at end of file
+    # persistent workers keep the decode pipeline alive across epochs, pinned batches let
+    # .cuda(non_blocking=True) overlap the H2D copy with the forward pass
+    data_loader = data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=(mode == 'train'), num_workers=num_workers,
+                                  pin_memory=True, persistent_workers=num_workers > 0,
+                                  prefetch_factor=4 if num_workers > 0 else None, drop_last=(mode == 'train'))
+    return data_loader
@@ -26,11 +26,15 @@ if __name__ == "__main__":
     parser.add_argument('--stepvalue2', default=100000, type=int, help='the step 2 for adjusting lr')
     parser.add_argument('--trainset', default='ISTD/ISTD', type=str, help='Trainging set')
     parser.add_argument('--save_model_dir', default='ckpt3/', type=str, help='save model path')
+    parser.add_argument('--compile_mode', default=None, type=str, help='torch.compile mode for the decoder, e.g. reduce-overhead')
+    parser.add_argument('--cache_path', default=None, type=str, help='prefix of the resized training set cache (.npy)')
 
     # test
     parser.add_argument('--Testing', default=True, type=bool, help='Testing or not')
     parser.add_argument('--save_test_path_root', default='preds3/', type=str, help='save saliency maps path')
     parser.add_argument('--test_paths', type=str, default='test_new')
+    parser.add_argument('--aot_patch_embed', action='store_true', help='AOT compile the decoder PatchEmbeds before testing')
+    parser.add_argument('--test_compile_mode', default=None, type=str, help='torch.compile mode for the decoder at test time')
 
     # evaluation
     parser.add_argument('--Evaluation', default=False, type=bool, help='Evaluation or not')